@@ -0,0 +1,74 @@
+"""
+Combining the CRC-32 check values of chunks into the check value of a file.
+"""
+import zlib
+
+from pigz_python.engines import isal_zlib
+
+
+# Reversed CRC-32 polynomial, as used by gzip and zlib
+_CRC32_POLY = 0xEDB88320
+
+
+def _multmodp(a: int, b: int) -> int:
+    """
+    Multiply a and b modulo the CRC-32 polynomial.
+    Both values are reflected polynomials, and a must be nonzero.
+    Note this is copied from the zlib implementation.
+    """
+    m = 1 << 31
+    p = 0
+    while True:
+        if a & m:
+            p ^= b
+            if (a & (m - 1)) == 0:
+                break
+        m >>= 1
+        b = (b >> 1) ^ _CRC32_POLY if b & 1 else b >> 1
+    return p
+
+
+def _build_x2n_table():
+    """
+    Build the table of x^2^n modulo the CRC-32 polynomial, for n = 0..31.
+    """
+    p = 1 << 30  # x^1
+    table = [p]
+    for _ in range(1, 32):
+        p = _multmodp(p, p)
+        table.append(p)
+    return table
+
+
+_X2N_TABLE = _build_x2n_table()
+
+
+def _x2nmodp(n: int, k: int) -> int:
+    """
+    Return x^(n * 2^k) modulo the CRC-32 polynomial.
+    """
+    p = 1 << 31  # x^0 == 1
+    while n:
+        if n & 1:
+            p = _multmodp(_X2N_TABLE[k & 31], p)
+        n >>= 1
+        k += 1
+    return p
+
+
+def _crc32_combine_python(crc1: int, crc2: int, len2: int) -> int:
+    """
+    Combine two CRC-32 check values into one.
+    crc1 is the check value of the first block of data, crc2 is the check value
+    of the second block of data, and len2 is the length of the second block.
+    """
+    return _multmodp(_x2nmodp(len2, 3), crc1) ^ crc2
+
+
+# Use a C implementation of crc32_combine where there is one (Python 3.14+,
+# isal 1.4+), so the write thread doesn't have to do polynomial arithmetic in Python
+crc32_combine = (
+    getattr(zlib, "crc32_combine", None)
+    or getattr(isal_zlib, "crc32_combine", None)
+    or _crc32_combine_python
+)
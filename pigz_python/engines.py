@@ -0,0 +1,43 @@
+"""
+The deflate implementations a PigzFile can compress with.
+"""
+import zlib
+from types import ModuleType
+from typing import Optional
+
+isal_zlib: Optional[ModuleType]
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+
+# Modules providing a zlib compatible compressobj, by engine name
+_ENGINES = {"zlib": zlib, "isal": isal_zlib}
+# ISA-L only has levels 0 (fastest) to 3 (best)
+_ISAL_BEST_COMPRESSION = 3
+# ISA-L is several times faster than zlib, but compresses less at the same
+# gzip level, so it's only used when asked for
+DEFAULT_ENGINE = "zlib"
+
+
+def get_engine(engine: str):
+    """
+    Return the zlib compatible module for the named compression engine.
+    """
+    if engine not in _ENGINES:
+        raise ValueError(
+            f"Unknown compression engine {engine!r}, expected one of {list(_ENGINES)}"
+        )
+    engine_module = _ENGINES[engine]
+    if engine_module is None:
+        raise ImportError(f"Compression engine {engine!r} is not installed")
+    return engine_module
+
+
+def determine_engine_level(compression_level: int, engine: str) -> int:
+    """
+    Map a gzip compression level (1 - 9) onto the levels the engine supports.
+    """
+    if engine == "isal":
+        return min(compression_level // 3, _ISAL_BEST_COMPRESSION)
+    return compression_level
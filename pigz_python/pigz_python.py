@@ -3,20 +3,42 @@ Functions and classes to speed up compression of files by utilizing
 multiple cores on a system.
 """
 import os
+import struct
 import sys
 import time
-import zlib
-from multiprocessing.dummy import Pool
+from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from pathlib import Path
-from queue import PriorityQueue
-from threading import Lock, Thread
-
-CPU_COUNT = os.cpu_count()
+from threading import Condition, Event, Semaphore, Thread
+
+from pigz_python.checksum import crc32_combine
+from pigz_python.engines import DEFAULT_ENGINE, get_engine
+from pigz_python.workers import (
+    TRAILER_SIZE,
+    compress_chunk,
+    compress_chunk_view,
+    compress_chunk_worker,
+    compress_mapped_chunk,
+    init_worker,
+    map_input_file,
+    prefetch,
+)
+
+CPU_COUNT = os.cpu_count() or 1
+# Block sizes are in KiB. Unless one is given, the block size is picked from the
+# file size, between these bounds
 DEFAULT_BLOCK_SIZE_KB = 128
+MAX_BLOCK_SIZE_KB = 16 * 1024
+# Chunks per worker to aim for, so that all workers stay busy
+_CHUNKS_PER_WORKER = 4
 
 # 1 is fastest but worst, 9 is slowest but best
 GZIP_COMPRESS_OPTIONS = list(range(1, 9 + 1))
 _COMPRESS_LEVEL_BEST = max(GZIP_COMPRESS_OPTIONS)
+_COMPRESS_LEVEL_FAST = min(GZIP_COMPRESS_OPTIONS)
+# Same as gzip, level 1 is often several times faster for output a few percent larger
+_COMPRESS_LEVEL_DEFAULT = 6
 
 # FLG bits
 FTEXT = 0x1
@@ -25,6 +47,25 @@ FEXTRA = 0x4
 FNAME = 0x8
 FCOMMENT = 0x10
 
+# Subfield ID of the FEXTRA member size field in indexed gzip files, as used by pgzip
+_INDEX_SUBFIELD_ID = b"IG"
+# Fixed header, XLEN, and the subfield holding the member size
+_INDEX_MEMBER_HEADER_SIZE = 20
+
+# Deflate refers back at most this far, so no more of the preceding input than
+# this is worth priming a chunk with
+_DICTIONARY_SIZE = 32 * 1024
+
+# Compressed size to reserve disk space for, as a share of the input size
+_ESTIMATED_COMPRESSION_RATIO = 0.7
+# Disk space is reserved at most this far ahead of the end of the output file.
+# File systems without native fallocate emulate it by writing every block,
+# so reserving the whole estimate at once would write it all up front.
+_RESERVE_STEP_SIZE = 64 * 1024 * 1024
+
+# Most buffers a single writev may take (the Linux and macOS limit)
+_IOV_MAX = 1024
+
 
 class PigzFile:  # pylint: disable=too-many-instance-attributes
     """Class to implement Pigz functionality in Python"""
@@ -33,38 +74,89 @@ class PigzFile:  # pylint: disable=too-many-instance-attributes
         self,
         compression_target,
         output_name=None,
-        compresslevel=_COMPRESS_LEVEL_BEST,
-        blocksize=DEFAULT_BLOCK_SIZE_KB,
+        compresslevel=_COMPRESS_LEVEL_DEFAULT,
+        blocksize=None,
         workers=CPU_COUNT,
-    ):
+        engine=DEFAULT_ENGINE,
+        indexed=False,
+        target_ratio=None,
+        target_mb_per_s=None,
+        threads=False,
+        dictionary=False,
+    ):  # pylint: disable=too-many-arguments
         """
         Take in a file or directory and gzip using multiple system cores.
+        blocksize is in KiB, and is picked from the size of the file when not given.
+        engine selects the deflate implementation, "zlib" or "isal". ISA-L is several
+        times faster, but its output is larger, as it has fewer levels than zlib.
+        indexed writes each chunk as its own gzip member, with its size in an
+        FEXTRA subfield, so that pgzip-style readers can decompress it in parallel.
+        target_ratio (compressed / uncompressed size) and target_mb_per_s (overall
+        MB/s) replace compresslevel with level 1 or 6, whichever meets them.
+        threads compresses on a pool of threads rather than processes. zlib and
+        ISA-L release the GIL while compressing, so threads still run in parallel,
+        without starting processes or sending results between them.
+        dictionary primes each chunk with the 32 KiB of input before it, as pigz
+        does unless given -i, so the output is a little smaller. Any gzip reader
+        can still decompress it, but every chunk needs a new compressor.
+        Members of an indexed file are never primed, they decompress on their own.
         """
         self.compression_target = Path(compression_target)
         self.compression_level = compresslevel
-        self.blocksize = blocksize * 1000
         self.workers = workers
+        # Fail early, rather than on the pool, if the engine can't be used
+        get_engine(engine)
+        self.engine = engine
+        self.indexed = indexed
+        self.target_ratio = target_ratio
+        self.target_mb_per_s = target_mb_per_s
+        self.threads = threads
+        self.dictionary = dictionary
 
         self.output_file = None
         self.output_filename = output_name
+        # Header fields shared by every member of an indexed file
+        self._member_header_prefix = b""
+        self._member_fname = b""
+
+        # The read thread maps the input file, to prefetch chunks and for thread workers
+        self._input_map = None
 
         # This is how we know if we're done reading, compressing, & writing the file
+        # The read thread sets _last_chunk once, then sets _read_done,
+        # so no lock is needed to read it
         self._last_chunk = -1
-        self._last_chunk_lock = Lock()
-        # This is calculated as data is written out
+        self._read_done = Event()
+        # This is combined from the per chunk check values as data is written out
         self.checksum = 0
         # This is calculated as data is read in
         self.input_size = 0
 
-        self.chunk_queue = PriorityQueue()
+        # Compressed chunks waiting to be written, keyed by chunk number
+        self._pending_chunks = {}
+        self._pending_chunks_cv = Condition()
+        # Bounds the chunks read but not yet written, which keeps memory use flat
+        # when reading outpaces compressing or writing
+        self._inflight = Semaphore(self.workers * 2)
+        # The first error of the read or write thread or a worker, which stops both
+        # threads and is raised again by process_compression_target
+        self._error = None
 
         if Path(compression_target).is_dir():
             raise NotImplementedError
         if not Path(compression_target).exists():
             raise FileNotFoundError
 
-        # Setup the system threads for compression
-        self.pool = Pool(processes=self.workers)
+        self.blocksize = self._determine_blocksize(blocksize)
+        # Disk space is reserved for the output as it grows, up to this estimate
+        self._estimated_output_size = int(
+            os.stat(compression_target).st_size * _ESTIMATED_COMPRESSION_RATIO
+        )
+        self._reserved_size = 0
+
+        # The system threads or processes for compression are only started for
+        # files that take more than one chunk, see _setup_workers
+        self.pool = None
         # Setup read thread
         self.read_thread = Thread(target=self._read_file)
         # Setup write thread
@@ -73,11 +165,18 @@ class PigzFile:  # pylint: disable=too-many-instance-attributes
     def process_compression_target(self):
         """
         Setup output file.
-        Start read and write threads.
-        Join to write thread.
+        Compress a file that fits in a single chunk right away, otherwise
+        start the workers, read and write threads, and join to write thread.
         """
+        if self.target_ratio is not None or self.target_mb_per_s is not None:
+            self._select_compression_level()
         self._setup_output_file()
 
+        if os.stat(self.compression_target).st_size <= self.blocksize:
+            self._compress_single_chunk()
+            return
+
+        self._setup_workers()
         # Start the write thread first so it's ready to accept data
         self.write_thread.start()
         # Start the read thread
@@ -86,6 +185,80 @@ class PigzFile:  # pylint: disable=too-many-instance-attributes
         # Block until writing is complete
         # This prevents us from returning prior to the work being done
         self.write_thread.join()
+        self.read_thread.join()
+        if self._error is not None:
+            self._close_workers()
+            raise self._error
+
+    def _setup_workers(self):
+        """
+        Setup the system threads or processes for compression
+        """
+        if self.threads:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        else:
+            self.pool = Pool(
+                processes=self.workers,
+                initializer=init_worker,
+                initargs=(self.compression_target,),
+            )
+
+    def _compress_single_chunk(self):
+        """
+        Compress a file that fits in a single chunk, on the calling thread.
+        Starting the workers, read and write threads would take longer than
+        compressing the chunk.
+        """
+        with open(self.compression_target, "rb") as input_file:
+            chunk = input_file.read()
+
+        self.input_size = len(chunk)
+        self._last_chunk = 1
+        result = compress_chunk_view(
+            1, chunk, self.compression_level, True, self.engine
+        )
+        _, self.checksum, _, _ = result
+        self._write_chunks(self._batch_buffers([result]))
+        self.clean_up()
+
+    def _select_compression_level(self):
+        """
+        Pick the fast or the default compression level to meet the targets,
+        by compressing a sample from the start of the file at both.
+        The default level is only picked if the fast level doesn't reach the
+        target ratio, and the default level is fast enough.
+        """
+        with open(self.compression_target, "rb") as input_file:
+            sample = input_file.read(min(self.blocksize, DEFAULT_BLOCK_SIZE_KB * 1024))
+        if not sample:
+            return
+
+        fast_ratio, _ = self._measure_compression_level(sample, _COMPRESS_LEVEL_FAST)
+        _, default_mb_per_s = self._measure_compression_level(
+            sample, _COMPRESS_LEVEL_DEFAULT
+        )
+        needs_default = self.target_ratio is None or fast_ratio > self.target_ratio
+        default_fast_enough = (
+            self.target_mb_per_s is None
+            or default_mb_per_s * self.workers >= self.target_mb_per_s
+        )
+        if needs_default and default_fast_enough:
+            self.compression_level = _COMPRESS_LEVEL_DEFAULT
+        else:
+            self.compression_level = _COMPRESS_LEVEL_FAST
+
+    def _measure_compression_level(self, sample: bytes, compression_level: int):
+        """
+        Compress the sample, returning the compression ratio and the speed of
+        a single worker in MB/s.
+        """
+        start = time.perf_counter()
+        compressed_sample = compress_chunk(sample, compression_level, True, self.engine)
+        elapsed = time.perf_counter() - start
+        ratio = len(compressed_sample) / len(sample)
+        # Guard against a clock too coarse to time the sample
+        mb_per_s = len(sample) / 1e6 / max(elapsed, 1e-9)
+        return ratio, mb_per_s
 
     def _set_output_filename(self):
         """
@@ -102,57 +275,37 @@ class PigzFile:  # pylint: disable=too-many-instance-attributes
         Write gzip header to file
         See RFC documentation: http://www.zlib.org/rfc-gzip.html#header-trailer
         """
-        self._write_header_id()
-        self._write_header_cm()
-
         # We must first figure out if we can write out the filename before writing FLG
         fname = self._determine_fname(self.compression_target)
         flags = 0x0
         if fname:
             flags = flags | FNAME
 
-        self._write_header_flg(flags)
-
-        self._write_header_mtime()
-        self._write_header_xfl()
-        self._write_header_os()
-
-        # After this point, content of flags (FLG) determines what (if anything)
-        # we write to header
-        if flags & FNAME:
-            # Write the FNAME
-            self.output_file.write(fname)
-
-    def _write_header_id(self):
-        """
-        Write ID (IDentification) ID1, then ID2 to file header
-        These denote the file as being gzip format
-        """
-        self.output_file.write((0x1F).to_bytes(1, sys.byteorder))
-        self.output_file.write((0x8B).to_bytes(1, sys.byteorder))
-
-    def _write_header_cm(self):
-        """Write the CM (compression method) to file header"""
-        self.output_file.write((8).to_bytes(1, sys.byteorder))
-
-    def _write_header_flg(self, flags):
-        """Write FLG (FLaGs)"""
-        self.output_file.write((flags).to_bytes(1, sys.byteorder))
-
-    def _write_header_mtime(self):
-        """Write MTIME (Modification time)"""
-        mtime = self._determine_mtime()
-        self.output_file.write((mtime).to_bytes(4, sys.byteorder))
-
-    def _write_header_xfl(self):
-        """Write XFL (eXtra FLags)"""
-        extra_flags = self._determine_extra_flags(self.compression_level)
-        self.output_file.write((extra_flags).to_bytes(1, sys.byteorder))
-
-    def _write_header_os(self):
-        """Write OS"""
-        os_number = self._determine_operating_system()
-        self.output_file.write((os_number).to_bytes(1, sys.byteorder))
+        # After the fixed fields, content of flags (FLG) determines what (if anything)
+        # we write to header. fname is empty if FNAME isn't set.
+        self.output_file.write(self._build_header(flags) + fname)
+
+    def _build_header(self, flags: int) -> bytes:
+        """
+        Build the fixed fields of the gzip header, all multi-byte fields are
+        little-endian:
+        ID1, ID2 (IDentification) denote the file as being gzip format
+        CM (Compression Method)
+        FLG (FLaGs)
+        MTIME (Modification TIME)
+        XFL (eXtra FLags)
+        OS (Operating System)
+        """
+        return struct.pack(
+            "<BBBBIBB",
+            0x1F,
+            0x8B,
+            8,
+            flags,
+            self._determine_mtime(),
+            self._determine_extra_flags(self.compression_level),
+            self._determine_operating_system(),
+        )
 
     def _setup_output_file(self):
         """
@@ -161,7 +314,107 @@ class PigzFile:  # pylint: disable=too-many-instance-attributes
         self._set_output_filename()
         full_path = Path(self.compression_target.parent, self.output_filename)
         self.output_file = open(full_path, "wb")
-        self._write_output_header()
+        if self.indexed:
+            # Every member gets its own header, written with its chunk
+            self._setup_member_header()
+        else:
+            self._write_output_header()
+
+    def _reserve_output_space(self, file_descriptor: int, length: int):
+        """
+        Reserve disk space ahead of writing length more bytes, where the platform
+        supports it, so the file isn't extended a little on every write.
+        Space is reserved a step at a time as the file grows, up to the estimated
+        size of the compressed data.
+        The file is trimmed to size by _release_output_file once it's written.
+        """
+        if not hasattr(os, "posix_fallocate"):
+            return
+        write_end = os.lseek(file_descriptor, 0, os.SEEK_CUR) + length
+        if write_end <= self._reserved_size:
+            return
+        reserve_end = min(write_end + _RESERVE_STEP_SIZE, self._estimated_output_size)
+        if reserve_end <= write_end:
+            # Past the estimate, the file just grows with each write
+            return
+        try:
+            os.posix_fallocate(
+                file_descriptor, self._reserved_size, reserve_end - self._reserved_size
+            )
+        except OSError:
+            # Not supported by the file system, or not enough space to reserve.
+            # Either way we can still write the file without it.
+            pass
+        self._reserved_size = reserve_end
+
+    def _release_output_file(self):
+        """
+        Trim the output file to what was written, dropping any space reserved for
+        it beyond that, and advise the kernel it won't be read back from cache.
+        """
+        file_descriptor = self.output_file.fileno()
+        # Chunks are written with writev, so ask the OS for the end of the file
+        # rather than the file object
+        os.ftruncate(file_descriptor, os.lseek(file_descriptor, 0, os.SEEK_CUR))
+        if hasattr(os, "posix_fadvise"):
+            # Starts writing back dirty pages, and drops the clean ones from cache
+            os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def _setup_member_header(self):
+        """
+        Build the gzip header fields shared by every member of an indexed file.
+        Member headers carry an 'IG' (Indexed Gzip) FEXTRA subfield holding the
+        size of the whole member, so readers can jump from member to member.
+        """
+        fname = self._determine_fname(self.compression_target)
+        flags = FEXTRA
+        if fname:
+            flags = flags | FNAME
+
+        # XLEN, then the subfield ID and its length
+        self._member_header_prefix = self._build_header(flags) + struct.pack(
+            "<H2sH", 8, _INDEX_SUBFIELD_ID, 4
+        )
+        self._member_fname = fname
+
+    def _member_buffers(self, chunk_crc: int, chunk_len: int, compressed_chunk):
+        """
+        Return the header, data, and trailer making up the gzip member of a chunk.
+        """
+        member_size = (
+            _INDEX_MEMBER_HEADER_SIZE
+            + len(self._member_fname)
+            + len(compressed_chunk)
+            + TRAILER_SIZE
+        )
+        header = (
+            self._member_header_prefix
+            + struct.pack("<I", member_size)
+            + self._member_fname
+        )
+        trailer = struct.pack("<II", chunk_crc, chunk_len & 0xFFFFFFFF)
+        return [header, compressed_chunk, trailer]
+
+    def _determine_blocksize(self, blocksize=None):
+        """
+        Determine the block size in bytes.
+        Unless a block size (in KiB) is given, aim for a few chunks per worker so
+        small files are still spread across all workers, while large files get
+        large blocks, which compress better and cost less per chunk.
+        """
+        if self.workers < 1:
+            raise ValueError(f"workers must be at least 1, not {self.workers!r}")
+        if blocksize is not None:
+            # Empty chunks would never reach the end of the file
+            if blocksize < 1:
+                raise ValueError(f"blocksize must be at least 1 KiB, not {blocksize!r}")
+            return blocksize * 1024
+
+        file_size = os.stat(self.compression_target).st_size
+        auto_blocksize = file_size // (self.workers * _CHUNKS_PER_WORKER)
+        return max(
+            DEFAULT_BLOCK_SIZE_KB * 1024, min(auto_blocksize, MAX_BLOCK_SIZE_KB * 1024)
+        )
 
     def _determine_mtime(self):
         """
@@ -233,102 +486,228 @@ class PigzFile:  # pylint: disable=too-many-instance-attributes
 
     def _read_file(self):
         """
-        Read {filename} in {blocksize} chunks.
+        Split {filename} into {blocksize} chunks.
+        Workers read their chunk straight from a memory map of the file,
+        so only offsets pass through here.
         This method is run on the read thread.
         """
+        try:
+            self._read_chunks()
+        except Exception as error:  # pylint: disable=broad-except
+            self._record_error(error)
+
+    def _read_chunks(self):
+        """
+        Apply the chunks of the file to the pool, until the last one or an error.
+        """
         # Initialize this to 0 so our increment sets first chunk to 1
         chunk_num = 0
+        offset = 0
         with open(self.compression_target, "rb") as input_file:
+            input_size = os.fstat(input_file.fileno()).st_size
+            # Stays open until clean up, thread workers may still be using it
+            self._input_map = map_input_file(input_file)
             while True:
-                chunk = input_file.read(self.blocksize)
-                # Break out of the loop if we didn't read anything
-                if not chunk:
-                    with self._last_chunk_lock:
-                        self._last_chunk = chunk_num
-                    break
+                length = min(self.blocksize, input_size - offset)
+                # An empty file still produces a single (empty) last chunk,
+                # which terminates the deflate stream.
+                is_last_chunk = offset + length >= input_size
 
-                self.input_size += len(chunk)
+                self.input_size += length
                 chunk_num += 1
-                # Apply this chunk to the pool
-                self.pool.apply_async(self._process_chunk, (chunk_num, chunk))
+                if is_last_chunk:
+                    self._last_chunk = chunk_num
+                    self._read_done.set()
+                # Wait until the writer has caught up, then apply this chunk to the pool
+                self._inflight.acquire()  # pylint: disable=consider-using-with
+                if self._error is not None:
+                    break
+                # Get the chunk paged in while it waits for a worker
+                prefetch(self._input_map, offset, length)
+                self._apply_chunk(
+                    chunk_num,
+                    offset,
+                    length,
+                    self.compression_level,
+                    # Members of an indexed file each end their own stream
+                    is_last_chunk or self.indexed,
+                    self.engine,
+                    self._dictionary_length(offset),
+                )
+                if is_last_chunk:
+                    break
+                offset += length
 
-    def _process_chunk(self, chunk_num: int, chunk: bytes):
+    def _dictionary_length(self, offset: int) -> int:
         """
-        Overall method to handle the chunk and pass it back to the write thread.
-        This method is run on the pool.
+        How much of the input before offset to prime the chunk at offset with.
         """
-        with self._last_chunk_lock:
-            last_chunk = chunk_num == self._last_chunk
-        compressed_chunk = self._compress_chunk(chunk, last_chunk)
-        self.chunk_queue.put((chunk_num, chunk, compressed_chunk))
+        if not self.dictionary or self.indexed:
+            return 0
+        return min(offset, _DICTIONARY_SIZE)
 
-    def _compress_chunk(self, chunk: bytes, is_last_chunk: bool):
+    def _apply_chunk(self, *args):
         """
-        Compress the chunk.
+        Apply a chunk to the pool, to be compressed and passed to the write thread.
         """
-        compressor = zlib.compressobj(
-            level=self.compression_level,
-            method=zlib.DEFLATED,
-            wbits=-zlib.MAX_WBITS,
-            memLevel=zlib.DEF_MEM_LEVEL,
-            strategy=zlib.Z_DEFAULT_STRATEGY,
-        )
-        compressed_data = compressor.compress(chunk)
-        if is_last_chunk:
-            compressed_data += compressor.flush(zlib.Z_FINISH)
+        if self.threads:
+            future = self.pool.submit(compress_mapped_chunk, self._input_map, *args)
+            future.add_done_callback(self._process_future)
         else:
-            compressed_data += compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.pool.apply_async(
+                compress_chunk_worker,
+                args,
+                callback=self._process_chunk,
+                error_callback=self._record_error,
+            )
 
-        return compressed_data
+    def _process_future(self, future):
+        """
+        Pass the compressed chunk of a finished thread pool task on.
+        This method is run on the thread of the pool that compressed the chunk.
+        """
+        # The executor logs and drops anything raised here, so pass errors on
+        error = future.exception()
+        if error is not None:
+            self._record_error(error)
+            return
+        self._process_chunk(future.result())
+
+    def _process_chunk(self, result: tuple):
+        """
+        Pass a compressed chunk back to the write thread.
+        This method is run on the result handler thread of the process pool.
+        """
+        with self._pending_chunks_cv:
+            self._pending_chunks[result[0]] = result
+            self._pending_chunks_cv.notify()
+
+    def _record_error(self, error: BaseException):
+        """
+        Keep the first error of the read or write thread or a worker, and wake
+        both threads so they stop.
+        """
+        with self._pending_chunks_cv:
+            if self._error is None:
+                self._error = error
+            self._pending_chunks_cv.notify()
+        # The read thread may be waiting for the writer to make room
+        self._inflight.release()
 
     def _write_file(self):
         """
-        Write compressed data to disk.
-        Read chunks off of the priority queue.
-        Priority is the chunk number, so we can keep track of which chunk to get next.
+        Write compressed data to disk, then clean up.
+        On an error the output file is closed as it is, the error is passed on to
+        process_compression_target, and the read thread is stopped.
         This is run from the write thread.
         """
+        try:
+            self._write_chunks_in_order()
+            self.clean_up()
+        except Exception as error:  # pylint: disable=broad-except
+            self._record_error(error)
+            # The file is incomplete either way, keep the first error
+            with suppress(OSError, ValueError):
+                self._release_output_file()
+            with suppress(OSError, ValueError):
+                self.output_file.close()
+
+    def _write_chunks_in_order(self):
+        """
+        Wait for each chunk to arrive in the pending chunks, in chunk number order,
+        and write it out.
+        """
         next_chunk_num = 1
+        # Max chunks per write, enough to keep up with every worker finishing at once
+        write_batch_size = max(8, self.workers)
+        # Bind what the loop uses once, rather than looking it up on every chunk
+        pending_chunks = self._pending_chunks
+        pending_chunks_cv = self._pending_chunks_cv
+        pop_pending_chunk = pending_chunks.pop
+        release_inflight = self._inflight.release
+        batch_buffers = self._batch_buffers
+        write_chunks = self._write_chunks
+        read_done = self._read_done.is_set
+        combine_crc32 = crc32_combine
+        checksum = self.checksum
         while True:
-            if not self.chunk_queue.empty():
-                chunk_num, chunk, compressed_chunk = self.chunk_queue.get()
-
-                if chunk_num != next_chunk_num:
-                    # If this isn't the next chunk we're looking for,
-                    # place it back on the queue and sleep
-                    self.chunk_queue.put((chunk_num, chunk, compressed_chunk))
-                    time.sleep(0.5)
-                else:
-                    # Calculate running checksum
-                    self.calculate_chunk_check(chunk)
-                    # Write chunk to file, advance next chunk we're looking for
-                    self.output_file.write(compressed_chunk)
-                    # If this was the last chunk,
-                    # we can break the loop and close the file
-                    if chunk_num == self._last_chunk:
-                        break
+            batch = []
+            with pending_chunks_cv:
+                # Chunks may complete out of order, so sleep until ours is done
+                while next_chunk_num not in pending_chunks:
+                    if self._error is not None:
+                        raise self._error
+                    pending_chunks_cv.wait()
+                # Take every chunk that's ready in order, to write them all at once
+                while (
+                    next_chunk_num in pending_chunks and len(batch) < write_batch_size
+                ):
+                    batch.append(pop_pending_chunk(next_chunk_num))
                     next_chunk_num += 1
-            else:
-                # If the queue is empty, we're likely waiting for data.
-                time.sleep(0.5)
-        # Loop breaks out if we've received the final chunk
-        self.clean_up()
 
-    def calculate_chunk_check(self, chunk: bytes):
+            for _, chunk_crc, chunk_len, _ in batch:
+                # Combine the chunk check value into the running checksum
+                checksum = combine_crc32(checksum, chunk_crc, chunk_len)
+            self.checksum = checksum
+            # Nothing keeps the written data around while waiting for the next batch
+            write_chunks(batch_buffers(batch))
+            for _ in batch:
+                # Let the read thread move on to another chunk
+                release_inflight()
+            # If this was the last chunk,
+            # we can break the loop and close the file
+            if read_done() and batch[-1][0] == self._last_chunk:
+                break
+
+    def _batch_buffers(self, batch: list) -> list:
+        """
+        Return the buffers to write out for a batch of compressed chunks.
+        """
+        if not self.indexed:
+            return [compressed_chunk for *_, compressed_chunk in batch]
+
+        buffers = []
+        for _, chunk_crc, chunk_len, compressed_chunk in batch:
+            buffers += self._member_buffers(chunk_crc, chunk_len, compressed_chunk)
+        return buffers
+
+    def _write_chunks(self, compressed_chunks: list):
         """
-        Calculate the check value for the chunk.
+        Write compressed chunks to the output file, in a single system call
+        where the platform supports it.
         """
-        self.checksum = zlib.crc32(chunk, self.checksum)
+        if not hasattr(os, "writev"):
+            self.output_file.write(b"".join(compressed_chunks))
+            return
+
+        # Anything still buffered (like the header) must land ahead of the chunks
+        self.output_file.flush()
+        file_descriptor = self.output_file.fileno()
+        buffers = [memoryview(chunk) for chunk in compressed_chunks]
+        self._reserve_output_space(
+            file_descriptor, sum(len(buffer) for buffer in buffers)
+        )
+        while buffers:
+            written = os.writev(file_descriptor, buffers[:_IOV_MAX])
+            # writev may stop short, drop what made it out and go again
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers[0])
+                buffers.pop(0)
+            if written:
+                buffers[0] = buffers[0][written:]
 
     def clean_up(self):
         """
         Close the output file.
         Clean up the processing pool.
         """
-        self.write_file_trailer()
+        # Members of an indexed file have their own trailers
+        if not self.indexed:
+            self.write_file_trailer()
 
         # Flush internal buffers
         self.output_file.flush()
+        self._release_output_file()
         self.output_file.close()
 
         self._close_workers()
@@ -337,29 +716,58 @@ class PigzFile:  # pylint: disable=too-many-instance-attributes
         """
         Write the trailer for the compressed data.
         """
-        # Write CRC32
-        self.output_file.write((self.checksum).to_bytes(4, sys.byteorder))
-        # Write ISIZE (Input SIZE)
-        # This contains the size of the original (uncompressed) input data modulo 2^32.
+        # Write CRC32, then ISIZE (Input SIZE)
+        # ISIZE contains the size of the original (uncompressed) input data
+        # modulo 2^32.
         self.output_file.write(
-            (self.input_size & 0xFFFFFFFF).to_bytes(4, sys.byteorder)
+            struct.pack("<II", self.checksum, self.input_size & 0xFFFFFFFF)
         )
 
     def _close_workers(self):
         """
-        Close compression thread pool.
+        Close compression thread or process pool, then the input file map.
         """
-        self.pool.close()
-        self.pool.join()
+        # A single chunk file is compressed without starting any workers
+        if self.pool is not None:
+            if self.threads:
+                self.pool.shutdown()
+            elif self._error is not None:
+                # Don't wait on chunks nobody will write, or on a worker that died
+                self.pool.terminate()
+                self.pool.join()
+            else:
+                self.pool.close()
+                self.pool.join()
+
+        if self._input_map is not None:
+            self._input_map.close()
 
 
 def compress_file(
     source_file,
     output_name=None,
-    compresslevel=_COMPRESS_LEVEL_BEST,
-    blocksize=DEFAULT_BLOCK_SIZE_KB,
+    compresslevel=_COMPRESS_LEVEL_DEFAULT,
+    blocksize=None,
     workers=CPU_COUNT,
-):
+    engine=DEFAULT_ENGINE,
+    indexed=False,
+    target_ratio=None,
+    target_mb_per_s=None,
+    threads=False,
+    dictionary=False,
+):  # pylint: disable=too-many-arguments
     """Helper function to call underlying class and compression method"""
-    pigz_file = PigzFile(source_file, output_name, compresslevel, blocksize, workers)
+    pigz_file = PigzFile(
+        source_file,
+        output_name,
+        compresslevel,
+        blocksize,
+        workers,
+        engine,
+        indexed,
+        target_ratio,
+        target_mb_per_s,
+        threads,
+        dictionary,
+    )
     pigz_file.process_compression_target()
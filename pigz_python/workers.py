@@ -0,0 +1,265 @@
+"""
+Compression of the chunks of a file, run on the worker processes or threads
+of a PigzFile.
+"""
+import mmap
+import os
+import platform
+import struct
+from pathlib import Path
+from threading import local
+from typing import Optional, Union
+
+from pigz_python.engines import determine_engine_level, get_engine
+
+# CRC32 and ISIZE
+TRAILER_SIZE = 8
+
+# Chunks are checked and compressed in tiles of this size, small enough to stay
+# in the L2 cache between the two
+_TILE_SIZE = 64 * 1024
+
+# Header zlib and ISA-L write for a gzip stream, no optional fields
+_GZIP_HEADER_SIZE = 10
+# Engines that check the data as a side effect of producing a gzip stream.
+# ISA-L folds crc32 into its deflate loop, and zlib on s390x uses the DFLTCC
+# instruction, which computes the check value in hardware while compressing.
+_CHECKING_ENGINES = {"isal"} | ({"zlib"} if platform.machine() == "s390x" else set())
+
+
+# Compressors each worker keeps between chunks, by engine and compression level
+_worker_compressors = local()
+
+
+def _new_compressor(compression_level: int, engine: str, wbits=None, zdict=None):
+    """
+    Create a compressor, by default for raw deflate.
+    zdict primes the compressor with data it may refer back to.
+    """
+    engine_module = get_engine(engine)
+    if wbits is None:
+        wbits = -engine_module.MAX_WBITS
+    args = [
+        determine_engine_level(compression_level, engine),
+        engine_module.DEFLATED,
+        wbits,
+        engine_module.DEF_MEM_LEVEL,
+        engine_module.Z_DEFAULT_STRATEGY,
+    ]
+    # compressobj takes no zdict of None
+    if zdict:
+        args.append(zdict)
+    return engine_module.compressobj(*args)
+
+
+def compress_chunk(
+    chunk: Union[bytes, memoryview],
+    compression_level: int,
+    is_last_chunk: bool,
+    engine: str,
+):
+    """
+    Compress the chunk.
+    """
+    compressed_data, _ = _compress_and_check_chunk(
+        chunk, compression_level, is_last_chunk, engine
+    )
+    return compressed_data
+
+
+def _compress_and_check_chunk(
+    chunk: Union[bytes, memoryview],
+    compression_level: int,
+    is_last_chunk: bool,
+    engine: str,
+    zdict=None,
+):
+    """
+    Compress the chunk, and calculate its check value in the same pass.
+    The chunk is checked and compressed a tile at a time, so the tile the check
+    just read is still in cache for the compressor.
+    Chunks other than the last end with a full flush, which byte aligns the output
+    and resets the compression history, so the compressor is as good as new and
+    is kept for the next chunk. The last chunk ends the stream, and the compressor.
+    A chunk primed with zdict needs a compressor of its own, which isn't kept.
+    """
+    engine_module = get_engine(engine)
+    if not hasattr(_worker_compressors, "compressors"):
+        _worker_compressors.compressors = {}
+    key = (engine, compression_level)
+    # Take the compressor out while it's in use, so it's dropped if this fails
+    if zdict:
+        compressor = _new_compressor(compression_level, engine, zdict=zdict)
+    else:
+        compressor = _worker_compressors.compressors.pop(key, None)
+    if compressor is None:
+        compressor = _new_compressor(compression_level, engine)
+
+    compressed_data = []
+    chunk_crc = 0
+    # Slicing a memoryview doesn't copy the tile
+    chunk_view = memoryview(chunk)
+    for start in range(0, len(chunk_view), _TILE_SIZE):
+        end = start + _TILE_SIZE
+        tile = chunk_view[start:end]
+        chunk_crc = engine_module.crc32(tile, chunk_crc)
+        compressed_data.append(compressor.compress(tile))
+    if is_last_chunk:
+        compressed_data.append(compressor.flush(engine_module.Z_FINISH))
+    else:
+        compressed_data.append(compressor.flush(engine_module.Z_FULL_FLUSH))
+        if not zdict:
+            _worker_compressors.compressors[key] = compressor
+
+    return b"".join(compressed_data), chunk_crc
+
+
+def _compress_checked_chunk(
+    chunk: Union[bytes, memoryview], compression_level: int, engine: str
+):
+    """
+    Compress the chunk as a complete gzip stream, and return its raw deflate data
+    along with the check value the engine calculated on the way.
+    The gzip header and trailer of the stream are dropped, we write our own.
+    This is the technique CPython's gzip.compress uses.
+    """
+    engine_module = get_engine(engine)
+    compressor = _new_compressor(
+        compression_level, engine, wbits=16 + engine_module.MAX_WBITS
+    )
+    gzip_stream = compressor.compress(chunk) + compressor.flush(engine_module.Z_FINISH)
+    (chunk_crc,) = struct.unpack_from(
+        "<I", gzip_stream, len(gzip_stream) - TRAILER_SIZE
+    )
+    return gzip_stream[_GZIP_HEADER_SIZE:-TRAILER_SIZE], chunk_crc
+
+
+def map_input_file(input_file):
+    """
+    Map the whole input file into memory, read only.
+    Returns None for an empty file, which can't be mapped.
+    """
+    if os.fstat(input_file.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def prefetch(input_map, offset: int, length: int):
+    """
+    Ask the kernel to start reading a range of the mapped input file into memory.
+    """
+    if input_map is None or not hasattr(mmap, "MADV_WILLNEED"):
+        return
+    # madvise needs a page aligned start
+    start = offset - offset % mmap.PAGESIZE
+    input_map.madvise(mmap.MADV_WILLNEED, start, offset + length - start)
+
+
+# The input file of the worker process, mapped into memory on first use
+# pylint: disable=invalid-name
+_worker_input_filename: Optional[Path] = None
+_worker_input_map: Optional[Union[mmap.mmap, bytes]] = None
+# pylint: enable=invalid-name
+
+
+def init_worker(input_filename):
+    """
+    Point a new worker process at the input file.
+    This function is run on the pool, once per worker process.
+    """
+    global _worker_input_filename, _worker_input_map  # pylint: disable=global-statement
+    _worker_input_filename = input_filename
+    _worker_input_map = None
+
+
+def _chunk_view(input_map, offset: int, length: int) -> memoryview:
+    """
+    Return a view of the chunk in the mapped input file, without copying it.
+    """
+    end = offset + length
+    return memoryview(input_map or b"")[offset:end]
+
+
+def _worker_chunk(offset: int, length: int) -> memoryview:
+    """
+    Return a view of the chunk in the input file of the worker process.
+    The file is mapped on first use, so after the read thread has sized it.
+    """
+    global _worker_input_map  # pylint: disable=global-statement
+    if _worker_input_map is None:
+        assert _worker_input_filename is not None, "init_worker was not run"
+        with open(_worker_input_filename, "rb") as input_file:
+            _worker_input_map = map_input_file(input_file) or b""
+    return _chunk_view(_worker_input_map, offset, length)
+
+
+def compress_chunk_view(
+    chunk_num: int,
+    chunk: memoryview,
+    compression_level: int,
+    is_last_chunk: bool,
+    engine: str,
+    zdict=None,
+):  # pylint: disable=too-many-arguments
+    """
+    Compress the chunk and calculate its check value.
+    zdict is the input just before the chunk, for the compressor to refer back to.
+    """
+    # A gzip stream can't be primed, so a primed chunk is checked separately
+    if is_last_chunk and engine in _CHECKING_ENGINES and not zdict:
+        # A chunk that ends the stream can be checked for free by the engine
+        compressed_chunk, chunk_crc = _compress_checked_chunk(
+            chunk, compression_level, engine
+        )
+        return chunk_num, chunk_crc, len(chunk), compressed_chunk
+
+    compressed_chunk, chunk_crc = _compress_and_check_chunk(
+        chunk, compression_level, is_last_chunk, engine, zdict
+    )
+    return chunk_num, chunk_crc, len(chunk), compressed_chunk
+
+
+def compress_chunk_worker(
+    chunk_num: int,
+    offset: int,
+    length: int,
+    compression_level: int,
+    is_last_chunk: bool,
+    engine: str,
+    dictionary_length: int = 0,
+):  # pylint: disable=too-many-arguments
+    """
+    Compress the chunk of the input file at offset, primed with the
+    dictionary_length bytes before it.
+    This function is run on the process pool, so it must not touch any state of
+    the PigzFile that submitted it.
+    """
+    with _worker_chunk(
+        offset - dictionary_length, dictionary_length
+    ) as zdict, _worker_chunk(offset, length) as chunk:
+        return compress_chunk_view(
+            chunk_num, chunk, compression_level, is_last_chunk, engine, zdict
+        )
+
+
+def compress_mapped_chunk(
+    input_map,
+    chunk_num: int,
+    offset: int,
+    length: int,
+    compression_level: int,
+    is_last_chunk: bool,
+    engine: str,
+    dictionary_length: int = 0,
+):  # pylint: disable=too-many-arguments
+    """
+    Compress the chunk of the mapped input file at offset, primed with the
+    dictionary_length bytes before it.
+    This function is run on the thread pool, which shares the map of the read thread.
+    """
+    with _chunk_view(
+        input_map, offset - dictionary_length, dictionary_length
+    ) as zdict, _chunk_view(input_map, offset, length) as chunk:
+        return compress_chunk_view(
+            chunk_num, chunk, compression_level, is_last_chunk, engine, zdict
+        )
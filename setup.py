@@ -22,6 +22,7 @@ setup(
     keywords="zip gzip compression",
     url="https://github.com/nix7drummer88/pigz-python",
     packages=find_packages(),
+    extras_require={"isal": ["isal"]},
     long_description=long_description,
     long_description_content_type="text/markdown",
     classifiers=[
@@ -0,0 +1,52 @@
+"""
+Unit tests for combining check values in Pigz Python
+"""
+import importlib
+import sys
+import unittest
+import zlib
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pigz_python.checksum as checksum_module
+import pigz_python.engines as engines
+from pigz_python.checksum import _crc32_combine_python, crc32_combine
+
+
+# pylint: disable=protected-access
+class TestChecksum(unittest.TestCase):
+    """Unit tests for combining CRC-32 check values"""
+
+    def test_crc32_combine(self):
+        """
+        Test that combining check values matches a running crc32
+        """
+        input_data1 = b"Lorem ipsum dolor sit amet" * 1000
+        input_data2 = b"consectetur adipiscing elit" * 777
+        expected_checksum = zlib.crc32(input_data1 + input_data2)
+
+        for combine in (crc32_combine, _crc32_combine_python):
+            checksum = combine(
+                zlib.crc32(input_data1), zlib.crc32(input_data2), len(input_data2)
+            )
+            self.assertEqual(checksum, expected_checksum)
+
+    def test_crc32_combine_empty_chunk(self):
+        """
+        Test that combining the check value of an empty chunk is a no-op
+        """
+        checksum = 2322970659
+        for combine in (crc32_combine, _crc32_combine_python):
+            self.assertEqual(combine(checksum, zlib.crc32(b""), 0), checksum)
+
+    def test_crc32_combine_without_c_implementation(self):
+        """
+        Test that the Python implementation is picked when neither zlib nor isal
+        has crc32_combine, as with isal before 1.4
+        """
+        with patch.dict(sys.modules, {"zlib": SimpleNamespace()}), patch.object(
+            engines, "isal_zlib", SimpleNamespace()
+        ):
+            reloaded = importlib.reload(checksum_module)
+            self.assertIs(reloaded.crc32_combine, reloaded._crc32_combine_python)
+        importlib.reload(checksum_module)
@@ -0,0 +1,19 @@
+"""
+Unit tests for the compression engines of Pigz Python
+"""
+import unittest
+
+import pigz_python.engines as engines
+
+
+class TestEngines(unittest.TestCase):
+    """Unit tests for picking and configuring compression engines"""
+
+    def test_determine_engine_level_isal(self):
+        """
+        Test that gzip compression levels are mapped onto the ISA-L levels
+        """
+        expected_levels = {1: 0, 2: 0, 3: 1, 5: 1, 6: 2, 8: 2, 9: 3}
+        for compression_level, expected_level in expected_levels.items():
+            level = engines.determine_engine_level(compression_level, "isal")
+            self.assertEqual(level, expected_level)
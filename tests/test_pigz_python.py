@@ -1,17 +1,30 @@
 """
 Unit tests for Pigz Python
 """
-import sys
+import gzip
+import os
+import shutil
+import struct
+import tempfile
 import unittest
 import zlib
 from pathlib import Path
 from unittest.mock import MagicMock, Mock, call, mock_open, patch
 
+import pigz_python.engines as engines
 import pigz_python.pigz_python as pigz_python
+import pigz_python.workers as workers
 
 LOREM_IPSUM_FILE = "lorem_ipsum.txt"
 
 
+def failing_worker(*_):
+    """
+    Stand in for a compression worker, that fails.
+    """
+    raise ValueError("compression failed")
+
+
 # pylint: disable=protected-access, too-many-public-methods
 class TestPigzPython(unittest.TestCase):
     """ Unit tests for PigzPython class """
@@ -38,6 +51,21 @@ class TestPigzPython(unittest.TestCase):
         with self.assertRaises(FileNotFoundError):
             pigz_python.PigzFile(Path("tests", "fake_file.txt"))
 
+    def test_unknown_engine_raise_error(self):
+        """
+        Test that PigzFile raises ValueError when given an unknown engine
+        """
+        with self.assertRaises(ValueError):
+            pigz_python.PigzFile(Path("tests", LOREM_IPSUM_FILE), engine="bzip2")
+
+    def test_missing_engine_raise_error(self):
+        """
+        Test that PigzFile raises ImportError when the engine isn't installed
+        """
+        with patch.dict(engines._ENGINES, {"isal": None}):
+            with self.assertRaises(ImportError):
+                pigz_python.PigzFile(Path("tests", LOREM_IPSUM_FILE), engine="isal")
+
     def test_determine_operating_system_windows(self):
         """
         Test finding operating system on Windows
@@ -142,6 +170,104 @@ class TestPigzPython(unittest.TestCase):
             xfl = pigz_python.PigzFile._determine_extra_flags(value)
             self.assertEqual(xfl, expected_xfl)
 
+    def test_determine_blocksize_given(self):
+        """
+        Test that a given block size is taken as KiB
+        """
+        self.assertEqual(self.pigz_file._determine_blocksize(64), 64 * 1024)
+
+    def test_determine_blocksize_invalid(self):
+        """
+        Test that a block size under 1 KiB, or fewer than one worker, is rejected
+        """
+        with self.assertRaises(ValueError):
+            self.pigz_file._determine_blocksize(0)
+        with self.assertRaises(ValueError):
+            pigz_python.PigzFile(Path("tests", LOREM_IPSUM_FILE), blocksize=-1)
+        with self.assertRaises(ValueError):
+            pigz_python.PigzFile(Path("tests", LOREM_IPSUM_FILE), workers=0)
+
+    def test_determine_blocksize_small_file(self):
+        """
+        Test that small files get the default block size
+        """
+        self.assertEqual(
+            self.pigz_file._determine_blocksize(),
+            pigz_python.DEFAULT_BLOCK_SIZE_KB * 1024,
+        )
+
+    def test_determine_blocksize_large_file(self):
+        """
+        Test that large files are split into a few chunks per worker, up to the
+        maximum block size
+        """
+        self.pigz_file.compression_target = MagicMock()
+        self.pigz_file.workers = 4
+        mock_stat = Mock()
+        with patch("os.stat", new=MagicMock(return_value=mock_stat)):
+            mock_stat.st_size = 64 * 1024 * 1024
+            self.assertEqual(self.pigz_file._determine_blocksize(), 4 * 1024 * 1024)
+            mock_stat.st_size = 64 * 1024 * 1024 * 1024
+            self.assertEqual(
+                self.pigz_file._determine_blocksize(),
+                pigz_python.MAX_BLOCK_SIZE_KB * 1024,
+            )
+
+    def test_default_compression_level(self):
+        """
+        Test that the default compression level is the gzip default
+        """
+        self.assertEqual(self.pigz_file.compression_level, 6)
+
+    def test_select_compression_level_ratio_met(self):
+        """
+        Test that the fast level is picked when it meets the target ratio
+        """
+        self.pigz_file.target_ratio = 0.5
+        self.pigz_file._measure_compression_level = MagicMock(
+            side_effect=[(0.4, 100.0), (0.3, 25.0)]
+        )
+        self.pigz_file._select_compression_level()
+        self.assertEqual(self.pigz_file.compression_level, 1)
+
+    def test_select_compression_level_ratio_missed(self):
+        """
+        Test that the default level is picked when the fast level misses the
+        target ratio
+        """
+        self.pigz_file.target_ratio = 0.35
+        self.pigz_file._measure_compression_level = MagicMock(
+            side_effect=[(0.4, 100.0), (0.3, 25.0)]
+        )
+        self.pigz_file._select_compression_level()
+        self.assertEqual(self.pigz_file.compression_level, 6)
+
+    def test_select_compression_level_too_slow(self):
+        """
+        Test that the fast level is picked when the default level is too slow
+        across all workers
+        """
+        self.pigz_file.workers = 2
+        self.pigz_file.target_mb_per_s = 60.0
+        self.pigz_file._measure_compression_level = MagicMock(
+            side_effect=[(0.4, 100.0), (0.3, 25.0)]
+        )
+        self.pigz_file._select_compression_level()
+        self.assertEqual(self.pigz_file.compression_level, 1)
+
+    def test_measure_compression_level(self):
+        """
+        Test that the compression ratio of the sample is measured
+        """
+        sample = Path("tests", LOREM_IPSUM_FILE).read_bytes()
+        expected_ratio = len(zlib.compress(sample, 1)[2:-4]) / len(sample)
+        self.pigz_file.engine = "zlib"
+
+        ratio, mb_per_s = self.pigz_file._measure_compression_level(sample, 1)
+
+        self.assertEqual(ratio, expected_ratio)
+        self.assertGreater(mb_per_s, 0)
+
     def test_set_output_filename(self):
         """
         Ensure output filenames are appropriate
@@ -186,34 +312,6 @@ class TestPigzPython(unittest.TestCase):
         expected_filename = b""
         self.assertEqual(fname, expected_filename)
 
-    def test_compress_chunk_last_chunk(self):
-        """
-        Test compressing data when it is the last chunk
-        """
-        input_data = b"This is a test string"
-        # This output data was generated with compression level 9
-        # As the test is written, if the PigzFile default is changed,
-        # this test data may also need to be updated.
-        expected_output = (
-            b"\x0b\xc9\xc8,V\x00\xa2D\x85\x92\xd4\xe2\x12\x85\xe2\x92\xa2\xcc\xbct\x00"
-        )
-        compressed_data = self.pigz_file._compress_chunk(input_data, is_last_chunk=True)
-        self.assertEqual(compressed_data, expected_output)
-
-    def test_compress_chunk_not_last_chunk(self):
-        """
-        Test compressing data when it is NOT the last chunk
-        """
-        input_data = b"This is a test string"
-        # This output data was generated with compression level 9
-        # As the test is written, if the PigzFile default is changed,
-        # this test data may also need to be updated.
-        expected_output = b"\n\xc9\xc8,V\x00\xa2D\x85\x92\xd4\xe2\x12\x85\xe2\x92\xa2\xcc\xbct\x00\x00\x00\x00\xff\xff"  # noqa; pylint: disable=line-too-long
-        compressed_data = self.pigz_file._compress_chunk(
-            input_data, is_last_chunk=False
-        )
-        self.assertEqual(compressed_data, expected_output)
-
     def test_close_workers(self):
         """
         Test that compression worker pool closed.
@@ -223,12 +321,41 @@ class TestPigzPython(unittest.TestCase):
         self.pigz_file.pool.close.assert_called_once()
         self.pigz_file.pool.join.assert_called_once()
 
+    def test_close_workers_threads(self):
+        """
+        Test that compression worker thread pool and the input map are closed.
+        """
+        self.pigz_file.threads = True
+        self.pigz_file.pool = MagicMock()
+        self.pigz_file._input_map = MagicMock()
+        self.pigz_file._close_workers()
+        self.pigz_file.pool.shutdown.assert_called_once()
+        self.pigz_file._input_map.close.assert_called_once()
+
+    def test_apply_chunk_threads(self):
+        """
+        Test that chunks submitted to the thread pool reach the write thread
+        """
+        self.pigz_file.threads = True
+        self.pigz_file.pool = pigz_python.ThreadPoolExecutor(max_workers=1)
+        self.pigz_file._input_map = b"really fun data"
+
+        self.pigz_file._apply_chunk(1, 7, 3, 6, True, "zlib")
+        self.pigz_file.pool.shutdown()
+
+        self.assertEqual(
+            self.pigz_file._pending_chunks,
+            {1: (1, zlib.crc32(b"fun"), 3, zlib.compress(b"fun", 6)[2:-4])},
+        )
+
     def test_process_compression_target(self):
         """
         Test that appropriate methods are called to compress the file
         """
         # Setup mocks
+        self.pigz_file.blocksize = 1000
         self.pigz_file._setup_output_file = MagicMock()
+        self.pigz_file._setup_workers = MagicMock()
         self.pigz_file.write_thread = MagicMock()
         self.pigz_file.read_thread = MagicMock()
 
@@ -237,9 +364,51 @@ class TestPigzPython(unittest.TestCase):
 
         # Assert appropriate methods called
         self.pigz_file._setup_output_file.assert_called_once()
+        self.pigz_file._setup_workers.assert_called_once()
         self.pigz_file.write_thread.start.assert_called_once()
         self.pigz_file.read_thread.start.assert_called_once()
         self.pigz_file.write_thread.join.assert_called_once()
+        self.pigz_file.read_thread.join.assert_called_once()
+
+    def test_process_compression_target_single_chunk(self):
+        """
+        Test that a file fitting in a single chunk is compressed without
+        starting any workers or threads
+        """
+        # Setup mocks
+        self.pigz_file._setup_output_file = MagicMock()
+        self.pigz_file._setup_workers = MagicMock()
+        self.pigz_file._compress_single_chunk = MagicMock()
+        self.pigz_file.write_thread = MagicMock()
+        self.pigz_file.read_thread = MagicMock()
+
+        # Call the target method
+        self.pigz_file.process_compression_target()
+
+        # Assert appropriate methods called
+        self.pigz_file._setup_output_file.assert_called_once()
+        self.pigz_file._compress_single_chunk.assert_called_once()
+        self.pigz_file._setup_workers.assert_not_called()
+        self.pigz_file.write_thread.start.assert_not_called()
+        self.pigz_file.read_thread.start.assert_not_called()
+
+    def test_compress_single_chunk(self):
+        """
+        Test that a single chunk file is compressed and written out whole
+        """
+        input_data = Path("tests", LOREM_IPSUM_FILE).read_bytes()
+        self.pigz_file.engine = "zlib"
+        self.pigz_file._write_chunks = MagicMock()
+        self.pigz_file.clean_up = MagicMock()
+
+        self.pigz_file._compress_single_chunk()
+
+        self.pigz_file._write_chunks.assert_called_once_with(
+            [zlib.compress(input_data, 6)[2:-4]]
+        )
+        self.assertEqual(self.pigz_file.checksum, zlib.crc32(input_data))
+        self.assertEqual(self.pigz_file.input_size, len(input_data))
+        self.pigz_file.clean_up.assert_called_once()
 
     def test_setup_output_file(self):
         """
@@ -263,66 +432,199 @@ class TestPigzPython(unittest.TestCase):
 
             self.pigz_file._write_output_header.assert_called_once()
 
-    def test_calculate_chunk_check_from_zero(self):
+    def test_read_file(self):
+        """
+        Test that every chunk is applied to the pool, and the last one is flagged
         """
-        Test that the crc32 check is properly handled from 0
+        self.pigz_file.blocksize = 1000
+        self.pigz_file.pool = MagicMock()
+        self.pigz_file._inflight = MagicMock()
+        input_size = Path("tests", LOREM_IPSUM_FILE).stat().st_size
+
+        self.pigz_file._read_file()
+
+        apply_async_calls = self.pigz_file.pool.apply_async.call_args_list
+        # The test file is a little under 3000 bytes
+        self.assertEqual(len(apply_async_calls), 3)
+        self.assertEqual(self.pigz_file._inflight.acquire.call_count, 3)
+        chunk_nums = [args[1][0] for args, _ in apply_async_calls]
+        offsets = [args[1][1] for args, _ in apply_async_calls]
+        lengths = [args[1][2] for args, _ in apply_async_calls]
+        is_last_chunks = [args[1][4] for args, _ in apply_async_calls]
+        self.assertEqual(chunk_nums, [1, 2, 3])
+        self.assertEqual(offsets, [0, 1000, 2000])
+        self.assertEqual(lengths, [1000, 1000, input_size - 2000])
+        self.assertEqual(is_last_chunks, [False, False, True])
+        self.assertEqual(self.pigz_file._last_chunk, 3)
+        self.assertTrue(self.pigz_file._read_done.is_set())
+        self.assertEqual(self.pigz_file.input_size, input_size)
+
+    def test_write_file(self):
+        """
+        Test that chunks are written in order and their check values combined
         """
-        input_data = b"really fun data"
-        checksum_init = 0
-        expected_checksum = zlib.crc32(input_data, checksum_init)
+        input_data1 = b"really fun data"
+        input_data2 = b"MORE fun data!"
+        expected_checksum = zlib.crc32(input_data1 + input_data2)
+        self.pigz_file._write_chunks = MagicMock()
+        self.pigz_file.clean_up = MagicMock()
+        self.pigz_file._inflight = MagicMock()
+        self.pigz_file._last_chunk = 2
+        self.pigz_file._read_done.set()
+        # Hand the chunks over out of order
+        self.pigz_file._process_chunk(
+            (2, zlib.crc32(input_data2), len(input_data2), b"second")
+        )
+        self.pigz_file._process_chunk(
+            (1, zlib.crc32(input_data1), len(input_data1), b"first")
+        )
 
-        self.pigz_file.calculate_chunk_check(input_data)
+        self.pigz_file._write_file()
 
+        # Both chunks were ready, so they go out in a single write
+        self.pigz_file._write_chunks.assert_called_once_with([b"first", b"second"])
         self.assertEqual(self.pigz_file.checksum, expected_checksum)
+        self.assertEqual(self.pigz_file._pending_chunks, {})
+        self.assertEqual(self.pigz_file._inflight.release.call_count, 2)
+        self.pigz_file.clean_up.assert_called_once()
 
-    def test_calculate_chunk_check_from_nonzero(self):
+    def test_batch_buffers(self):
         """
-        Test that the crc32 check is properly handled from nonzero
+        Test that only the compressed data of a batch is written out
         """
-        input_data1 = b"really fun data"
-        input_data2 = b"MORE fun data!"
-        running_checksum = 0
-        running_checksum = zlib.crc32(input_data1, running_checksum)
-        expected_checksum = zlib.crc32(input_data2, running_checksum)
+        batch = [(1, 8675309, 42069, b"first"), (2, 8675309, 42069, b"second")]
+        self.assertEqual(self.pigz_file._batch_buffers(batch), [b"first", b"second"])
 
-        # Initialize checksum
-        self.pigz_file.checksum = 2322970659
-        # Calculate for second set of data
-        self.pigz_file.calculate_chunk_check(input_data2)
+    def test_batch_buffers_indexed(self):
+        """
+        Test that each chunk of an indexed file is wrapped in its own gzip member
+        """
+        self.pigz_file.indexed = True
+        self.pigz_file._member_buffers = MagicMock(side_effect=[[b"1"], [b"2", b"3"]])
+        batch = [(1, 8675309, 42069, b"first"), (2, 2322970659, 1337, b"second")]
 
-        self.assertEqual(self.pigz_file.checksum, expected_checksum)
+        buffers = self.pigz_file._batch_buffers(batch)
+
+        self.assertEqual(buffers, [b"1", b"2", b"3"])
+        self.pigz_file._member_buffers.assert_has_calls(
+            [call(8675309, 42069, b"first"), call(2322970659, 1337, b"second")]
+        )
 
-    def test_write_header_id(self):
+    def test_write_chunks(self):
         """
-        Test that we properly write the ID1 and ID2 fields of the gzip header
+        Test that chunks are written after anything already buffered
         """
-        self.pigz_file.output_file = MagicMock()
-        ID1 = (0x1F).to_bytes(1, sys.byteorder)  # pylint: disable=invalid-name
-        ID2 = (0x8B).to_bytes(1, sys.byteorder)  # pylint: disable=invalid-name
-        with patch("sys.byteorder", "little"):
-            self.pigz_file._write_header_id()
-            self.pigz_file.output_file.write.assert_has_calls([call(ID1), call(ID2)])
+        with tempfile.TemporaryFile() as output_file:
+            self.pigz_file.output_file = output_file
+            # Don't reserve space past what's written
+            self.pigz_file._estimated_output_size = 0
+            output_file.write(b"header ")
+
+            self.pigz_file._write_chunks([b"first ", b"", b"second"])
 
-    def test_write_header_cm(self):
+            output_file.seek(0)
+            self.assertEqual(output_file.read(), b"header first second")
+
+    @unittest.skipIf(not hasattr(pigz_python.os, "writev"), "writev is unavailable")
+    def test_write_chunks_short_writes(self):
         """
-        Test that we properly write the CM field of the gzip header
+        Test that writing continues where writev stopped short
         """
+        written_data = []
+
+        def writev_three_bytes(_, buffers):
+            data = b"".join(buffers)[:3]
+            written_data.append(data)
+            return len(data)
+
         self.pigz_file.output_file = MagicMock()
-        CM = (8).to_bytes(1, sys.byteorder)  # pylint: disable=invalid-name
-        with patch("sys.byteorder", "little"):
-            self.pigz_file._write_header_cm()
-            self.pigz_file.output_file.write.assert_has_calls([call(CM)])
+        self.pigz_file._reserve_output_space = MagicMock()
+        with patch("os.writev", new=writev_three_bytes):
+            self.pigz_file._write_chunks([b"first", b"second"])
+
+        self.assertEqual(b"".join(written_data), b"firstsecond")
+        self.pigz_file.output_file.flush.assert_called_once()
 
-    def test_write_header_flg(self):
+    def test_write_chunks_without_writev(self):
         """
-        Test that we properly write the FLG field of the gzip header
+        Test that chunks are joined into one write when writev is unavailable
         """
         self.pigz_file.output_file = MagicMock()
-        flags = 0xA
-        write_flags = (flags).to_bytes(1, sys.byteorder)
-        with patch("sys.byteorder", "little"):
-            self.pigz_file._write_header_flg(flags)
-            self.pigz_file.output_file.write.assert_has_calls([call(write_flags)])
+        with patch.object(pigz_python, "os", spec=["name"]):
+            self.pigz_file._write_chunks([b"first", b"second"])
+
+        self.pigz_file.output_file.write.assert_called_once_with(b"firstsecond")
+
+    @unittest.skipIf(
+        not hasattr(pigz_python.os, "posix_fallocate"), "posix_fallocate is unavailable"
+    )
+    def test_reserve_and_release_output_file(self):
+        """
+        Test that space reserved for the output file is trimmed once it's written
+        """
+        with tempfile.TemporaryFile() as output_file:
+            self.pigz_file.output_file = output_file
+            self.pigz_file._write_chunks([b"compressed data"])
+            self.assertGreater(os.fstat(output_file.fileno()).st_size, 15)
+
+            self.pigz_file._release_output_file()
+
+            self.assertEqual(os.fstat(output_file.fileno()).st_size, 15)
+
+    @unittest.skipIf(
+        not hasattr(pigz_python.os, "posix_fallocate"), "posix_fallocate is unavailable"
+    )
+    def test_reserve_output_space_in_steps(self):
+        """
+        Test that disk space is reserved a step ahead of the writes as the file
+        grows, never more than the estimated size at once
+        """
+        step = pigz_python._RESERVE_STEP_SIZE
+        self.pigz_file._estimated_output_size = step * 3
+        with patch("os.posix_fallocate") as mock_fallocate, patch(
+            "os.lseek", side_effect=[0, 10, step + 10, step * 3]
+        ):
+            self.pigz_file._reserve_output_space(3, 10)
+            # Still inside the reserved space
+            self.pigz_file._reserve_output_space(3, 10)
+            # Just past it, reserve another step
+            self.pigz_file._reserve_output_space(3, 10)
+            # Past the estimate
+            self.pigz_file._reserve_output_space(3, 10)
+
+        self.assertEqual(
+            mock_fallocate.call_args_list,
+            [call(3, 0, step + 10), call(3, step + 10, step + 10)],
+        )
+
+    def test_build_header(self):
+        """
+        Test that we properly build the fixed fields of the gzip header
+        """
+        self.pigz_file._determine_mtime = MagicMock(return_value=8675309)
+        self.pigz_file._determine_extra_flags = MagicMock(return_value=2)
+        self.pigz_file._determine_operating_system = MagicMock(return_value=3)
+        ID1 = b"\x1f"  # pylint: disable=invalid-name
+        ID2 = b"\x8b"  # pylint: disable=invalid-name
+        CM = b"\x08"  # pylint: disable=invalid-name
+        FLG = b"\x0a"  # pylint: disable=invalid-name
+        MTIME = (8675309).to_bytes(4, "little")  # pylint: disable=invalid-name
+        XFL = b"\x02"  # pylint: disable=invalid-name
+        OS = b"\x03"  # pylint: disable=invalid-name
+
+        header = self.pigz_file._build_header(0xA)
+
+        self.assertEqual(header, ID1 + ID2 + CM + FLG + MTIME + XFL + OS)
+
+    def test_build_header_big_endian_host(self):
+        """
+        Test that the gzip header is little-endian regardless of the host
+        """
+        self.pigz_file._determine_mtime = MagicMock(return_value=0x01020304)
+        with patch("sys.byteorder", "big"):
+            header = self.pigz_file._build_header(0x0)
+
+        self.assertEqual(header[4:8], b"\x04\x03\x02\x01")
 
     def test_write_output_header_with_fname(self):
         """
@@ -331,21 +633,13 @@ class TestPigzPython(unittest.TestCase):
         # Setup mocks
         self.pigz_file.output_file = MagicMock()
         self.pigz_file.compression_target = "foo.txt"
-        self.pigz_file._write_header_id = MagicMock()
-        self.pigz_file._write_header_cm = MagicMock()
-        self.pigz_file._write_header_flg = MagicMock()
-        self.pigz_file._write_header_mtime = MagicMock()
-        self.pigz_file._write_header_xfl = MagicMock()
-        self.pigz_file._write_header_os = MagicMock()
+        self.pigz_file._build_header = MagicMock(return_value=b"header")
         # Make the call
         self.pigz_file._write_output_header()
         # Assertions
-        self.pigz_file._write_header_id.assert_called_once()
-        self.pigz_file._write_header_cm.assert_called_once()
-        self.pigz_file._write_header_flg.assert_called_with(pigz_python.FNAME)
-        self.pigz_file._write_header_mtime.assert_called_once()
-        self.pigz_file._write_header_xfl.assert_called_once()
-        self.pigz_file._write_header_os.assert_called_once()
+        self.pigz_file._build_header.assert_called_with(pigz_python.FNAME)
+        # The whole header goes out in a single write
+        self.pigz_file.output_file.write.assert_called_once_with(b"headerfoo.txt\0")
 
     def test_write_output_header_without_fname(self):
         """
@@ -354,85 +648,37 @@ class TestPigzPython(unittest.TestCase):
         # Setup mocks
         self.pigz_file.output_file = MagicMock()
         self.pigz_file.compression_target = "В Питере — пить.mp3"
-        self.pigz_file._write_header_id = MagicMock()
-        self.pigz_file._write_header_cm = MagicMock()
-        self.pigz_file._write_header_flg = MagicMock()
-        self.pigz_file._write_header_mtime = MagicMock()
-        self.pigz_file._write_header_xfl = MagicMock()
-        self.pigz_file._write_header_os = MagicMock()
+        self.pigz_file._build_header = MagicMock(return_value=b"header")
         # Make the call
         self.pigz_file._write_output_header()
         # Assertions
-        self.pigz_file._write_header_id.assert_called_once()
-        self.pigz_file._write_header_cm.assert_called_once()
-
-        self.pigz_file._write_header_flg.assert_called_with(0x0)
-
-        self.pigz_file._write_header_mtime.assert_called_once()
-        self.pigz_file._write_header_xfl.assert_called_once()
-        self.pigz_file._write_header_os.assert_called_once()
-
-    def test_write_header_mtime(self):
-        """
-        Test writing out the mtime to the header
-        """
-        test_time = 8675309
-        test_time_bytes = (test_time).to_bytes(4, sys.byteorder)
-        self.pigz_file._determine_mtime = MagicMock()
-        self.pigz_file._determine_mtime.return_value = test_time
-        self.pigz_file.output_file = MagicMock()
-
-        self.pigz_file._write_header_mtime()
-
-        self.pigz_file.output_file.write.assert_called_with(test_time_bytes)
-
-    def test_write_header_xfl(self):
-        """
-        Test writing out xfl to the header
-        """
-        extra_flags = 2
-        extra_flags_bytes = (extra_flags).to_bytes(1, sys.byteorder)
-        self.pigz_file._determine_extra_flags = MagicMock()
-        self.pigz_file._determine_extra_flags.return_value = extra_flags
-        self.pigz_file.output_file = MagicMock()
-
-        self.pigz_file._write_header_xfl()
+        self.pigz_file._build_header.assert_called_with(0x0)
+        self.pigz_file.output_file.write.assert_called_once_with(b"header")
 
-        self.pigz_file.output_file.write.assert_called_with(extra_flags_bytes)
-
-    def test_write_header_os(self):
+    def test_process_chunk(self):
         """
-        Test writing out os to the header
+        Test calling process chunk
         """
-        os_field = 3
-        os_field_bytes = (os_field).to_bytes(1, sys.byteorder)
-        self.pigz_file._determine_operating_system = MagicMock()
-        self.pigz_file._determine_operating_system.return_value = os_field
-        self.pigz_file.output_file = MagicMock()
+        result = (2, 8675309, 42069, b"Jamiroquai")
 
-        self.pigz_file._write_header_os()
+        self.pigz_file._process_chunk(result)
 
-        self.pigz_file.output_file.write.assert_called_with(os_field_bytes)
+        self.assertEqual(self.pigz_file._pending_chunks, {2: result})
 
-    def test_process_chunk(self):
+    def test_dictionary_length(self):
         """
-        Test calling process chunk
+        Test that chunks are primed with up to 32 KiB of the input before them,
+        and only when asked to and not indexed
         """
-        chunk_num = 2
-        chunk = b"What can I do? I can't take up and down like this no more, babe I need to find out where I am Before I reach the stars Yeah, before I step on Mars"  # noqa; pylint: disable=line-too-long
-        compressed_chunk = b"Jamiroquai"
-        self.pigz_file._last_chunk = chunk_num
-        self.pigz_file._compress_chunk = MagicMock()
-        self.pigz_file._compress_chunk.return_value = compressed_chunk
-        self.pigz_file.chunk_queue = MagicMock()
+        self.assertEqual(self.pigz_file._dictionary_length(100 * 1024), 0)
 
-        self.pigz_file._process_chunk(chunk_num, chunk)
+        self.pigz_file.dictionary = True
+        self.assertEqual(self.pigz_file._dictionary_length(0), 0)
+        self.assertEqual(self.pigz_file._dictionary_length(1000), 1000)
+        self.assertEqual(self.pigz_file._dictionary_length(100 * 1024), 32 * 1024)
 
-        # Second arg is True since we've setup the test data as last chunk
-        self.pigz_file._compress_chunk.assert_called_with(chunk, True)
-        self.pigz_file.chunk_queue.put.assert_called_with(
-            (chunk_num, chunk, compressed_chunk)
-        )
+        self.pigz_file.indexed = True
+        self.assertEqual(self.pigz_file._dictionary_length(100 * 1024), 0)
 
     def test_clean_up(self):
         """
@@ -440,12 +686,14 @@ class TestPigzPython(unittest.TestCase):
         """
         self.pigz_file.write_file_trailer = MagicMock()
         self.pigz_file.output_file = MagicMock()
+        self.pigz_file._release_output_file = MagicMock()
         self.pigz_file._close_workers = MagicMock()
 
         self.pigz_file.clean_up()
 
         self.pigz_file.write_file_trailer.assert_called_once()
         self.pigz_file.output_file.flush.assert_called_once()
+        self.pigz_file._release_output_file.assert_called_once()
         self.pigz_file.output_file.close.assert_called_once()
         self.pigz_file._close_workers.assert_called_once()
 
@@ -454,9 +702,9 @@ class TestPigzPython(unittest.TestCase):
         Test writing the file trailer
         """
         checksum = 8675309
-        checksum_bytes = (checksum).to_bytes(4, sys.byteorder)
+        checksum_bytes = (checksum).to_bytes(4, "little")
         input_size = 42069
-        input_size_bytes = (input_size & 0xFFFFFFFF).to_bytes(4, sys.byteorder)
+        input_size_bytes = (input_size & 0xFFFFFFFF).to_bytes(4, "little")
 
         self.pigz_file.output_file = MagicMock()
         self.pigz_file.checksum = checksum
@@ -464,10 +712,41 @@ class TestPigzPython(unittest.TestCase):
 
         self.pigz_file.write_file_trailer()
 
-        self.pigz_file.output_file.write.assert_has_calls(
-            [call(checksum_bytes), call(input_size_bytes)]
+        self.pigz_file.output_file.write.assert_called_once_with(
+            checksum_bytes + input_size_bytes
         )
 
+    def test_write_file_trailer_big_endian_host(self):
+        """
+        Test that the file trailer is little-endian regardless of the host
+        """
+        self.pigz_file.output_file = MagicMock()
+        self.pigz_file.checksum = 0x01020304
+        self.pigz_file.input_size = 0x0A0B0C0D
+        with patch("sys.byteorder", "big"):
+            self.pigz_file.write_file_trailer()
+
+        self.pigz_file.output_file.write.assert_called_once_with(
+            b"\x04\x03\x02\x01\x0d\x0c\x0b\x0a"
+        )
+
+    def test_member_buffers_big_endian_host(self):
+        """
+        Test that the member size and trailer of an indexed member are
+        little-endian regardless of the host
+        """
+        self.pigz_file._member_header_prefix = b"prefix"
+        self.pigz_file._member_fname = b""
+        with patch("sys.byteorder", "big"):
+            header, data, trailer = self.pigz_file._member_buffers(
+                0x01020304, 0x0A0B0C0D, b"data"
+            )
+
+        # 20 header bytes, 4 data bytes and 8 trailer bytes
+        self.assertEqual(header, b"prefix" + (32).to_bytes(4, "little"))
+        self.assertEqual(data, b"data")
+        self.assertEqual(trailer, b"\x04\x03\x02\x01\x0d\x0c\x0b\x0a")
+
     def test_determine_mtime_normal(self):
         """
         Test normal case of determing mtime of compression target
@@ -495,3 +774,176 @@ class TestPigzPython(unittest.TestCase):
                 mtime = self.pigz_file._determine_mtime()
                 assert isinstance(mtime, int)
                 self.assertEqual(mtime, 9440351000)
+
+
+class TestCompressFile(unittest.TestCase):
+    """ End to end tests for compressing a file """
+
+    def setUp(self):
+        """
+        Copy the test file into a temporary directory to compress it there.
+        """
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.test_file = Path(self.temp_dir.name, LOREM_IPSUM_FILE)
+        shutil.copy(Path("tests", LOREM_IPSUM_FILE), self.test_file)
+
+    def tearDown(self):
+        """
+        Remove the temporary directory and everything in it.
+        """
+        self.temp_dir.cleanup()
+
+    def assert_round_trip(self, **kwargs):
+        """
+        Compress the test file and check it decompresses to the original data.
+        """
+        pigz_python.compress_file(self.test_file, **kwargs)
+
+        compressed_file = Path(self.temp_dir.name, f"{LOREM_IPSUM_FILE}.gz")
+        self.assertEqual(
+            gzip.decompress(compressed_file.read_bytes()), self.test_file.read_bytes()
+        )
+
+    def test_compress_file_single_chunk(self):
+        """
+        Test compressing a file that fits in a single chunk
+        """
+        self.assert_round_trip()
+
+    def test_compress_file_multiple_chunks(self):
+        """
+        Test compressing a file that spans multiple chunks
+        """
+        self.assert_round_trip(blocksize=1)
+
+    @unittest.skipIf(engines.isal_zlib is None, "isal is not installed")
+    def test_compress_file_isal(self):
+        """
+        Test compressing a file with the ISA-L engine
+        """
+        self.assert_round_trip(blocksize=1, engine="isal")
+
+    def test_compress_file_zlib(self):
+        """
+        Test compressing a file with the zlib engine
+        """
+        self.assert_round_trip(blocksize=1, engine="zlib")
+
+    def test_compress_file_indexed(self):
+        """
+        Test that an indexed file is one gzip member per chunk, each carrying
+        its own size in the FEXTRA field.
+        The size is of the whole member, header and trailer included, as pgzip
+        reads it, not of the deflate data alone as mgzip writes it.
+        """
+        self.assert_round_trip(blocksize=1, indexed=True)
+
+        compressed_file = Path(self.temp_dir.name, f"{LOREM_IPSUM_FILE}.gz")
+        compressed_data = compressed_file.read_bytes()
+        member_offset = 0
+        member_count = 0
+        while member_offset < len(compressed_data):
+            flags, xlen, subfield_id, subfield_len, member_size = struct.unpack_from(
+                "<3xB6xH2sHI", compressed_data, member_offset
+            )
+            self.assertEqual(flags, pigz_python.FEXTRA | pigz_python.FNAME)
+            self.assertEqual((xlen, subfield_id, subfield_len), (8, b"IG", 4))
+            member_end = member_offset + member_size
+            # The member ends exactly where the gzip stream it holds does
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            decompressor.decompress(compressed_data[member_offset:member_end])
+            self.assertTrue(decompressor.eof)
+            self.assertEqual(decompressor.unused_data, b"")
+            member_offset = member_end
+            member_count += 1
+        self.assertEqual(member_offset, len(compressed_data))
+        # The test file is a little under 3000 bytes
+        self.assertEqual(member_count, 3)
+
+    def test_compress_file_threads(self):
+        """
+        Test compressing a file on a thread pool
+        """
+        self.assert_round_trip(blocksize=1, threads=True)
+
+    def test_compress_file_threads_indexed(self):
+        """
+        Test compressing an indexed file on a thread pool
+        """
+        self.assert_round_trip(blocksize=1, threads=True, indexed=True)
+
+    def test_compress_file_dictionary(self):
+        """
+        Test that priming chunks with the input before them round trips, and
+        makes the output smaller
+        """
+        self.assert_round_trip(blocksize=1, engine="zlib")
+        compressed_file = Path(self.temp_dir.name, f"{LOREM_IPSUM_FILE}.gz")
+        unprimed_size = compressed_file.stat().st_size
+
+        self.assert_round_trip(blocksize=1, engine="zlib", dictionary=True)
+        self.assertLess(compressed_file.stat().st_size, unprimed_size)
+
+    @unittest.skipIf(engines.isal_zlib is None, "isal is not installed")
+    def test_compress_file_dictionary_isal(self):
+        """
+        Test that priming chunks with the input before them round trips with isal
+        """
+        self.assert_round_trip(blocksize=1, engine="isal", dictionary=True)
+
+    def test_compress_file_threads_dictionary(self):
+        """
+        Test that thread workers prime chunks from the shared input map
+        """
+        self.assert_round_trip(blocksize=1, threads=True, dictionary=True)
+
+    def test_compress_file_threads_empty(self):
+        """
+        Test compressing an empty file on a thread pool
+        """
+        self.test_file.write_bytes(b"")
+        self.assert_round_trip(threads=True)
+
+    def test_compress_file_empty(self):
+        """
+        Test compressing an empty file
+        """
+        self.test_file.write_bytes(b"")
+        self.assert_round_trip()
+
+    @unittest.skipIf(not hasattr(os, "writev"), "writev is unavailable")
+    def test_compress_file_write_error(self):
+        """
+        Test that an error writing the output is raised once both threads have
+        stopped, and the space reserved for the output is released
+        """
+        # A single worker leaves the read thread waiting for room to read ahead
+        pigz_file = pigz_python.PigzFile(self.test_file, blocksize=1, workers=1)
+        with patch("os.writev", side_effect=OSError(28, "No space left on device")):
+            with self.assertRaises(OSError):
+                pigz_file.process_compression_target()
+
+        self.assertFalse(pigz_file.read_thread.is_alive())
+        self.assertFalse(pigz_file.write_thread.is_alive())
+        # Only the header made it out, and nothing is reserved past it
+        compressed_file = Path(self.temp_dir.name, f"{LOREM_IPSUM_FILE}.gz")
+        self.assertEqual(
+            compressed_file.stat().st_size,
+            workers._GZIP_HEADER_SIZE + len(f"{LOREM_IPSUM_FILE}\0"),
+        )
+
+    def test_compress_file_threads_worker_error(self):
+        """
+        Test that an error compressing a chunk on a thread is raised
+        """
+        with patch.object(pigz_python, "compress_mapped_chunk", new=failing_worker):
+            with self.assertRaisesRegex(ValueError, "compression failed"):
+                pigz_python.compress_file(self.test_file, blocksize=1, threads=True)
+
+    def test_compress_file_worker_error(self):
+        """
+        Test that an error compressing a chunk in a worker process is raised
+        """
+        with patch.object(pigz_python, "compress_chunk_worker", new=failing_worker):
+            with self.assertRaisesRegex(ValueError, "compression failed"):
+                pigz_python.compress_file(self.test_file, blocksize=1)
@@ -0,0 +1,180 @@
+"""
+Unit tests for the compression workers of Pigz Python
+"""
+import tempfile
+import unittest
+import zlib
+from pathlib import Path
+from unittest.mock import patch
+
+import pigz_python.pigz_python as pigz_python
+import pigz_python.workers as workers
+
+LOREM_IPSUM_FILE = "lorem_ipsum.txt"
+
+
+# pylint: disable=protected-access
+class TestWorkers(unittest.TestCase):
+    """Unit tests for compressing chunks on the workers"""
+
+    def test_compress_chunk_last_chunk(self):
+        """
+        Test compressing data when it is the last chunk
+        """
+        input_data = b"This is a test string"
+        # This output data was generated with compression level 6
+        # As the test is written, if the PigzFile default is changed,
+        # this test data may also need to be updated.
+        expected_output = (
+            b"\x0b\xc9\xc8,V\x00\xa2D\x85\x92\xd4\xe2\x12\x85\xe2\x92\xa2\xcc\xbct\x00"
+        )
+        compressed_data = workers.compress_chunk(
+            input_data, pigz_python._COMPRESS_LEVEL_DEFAULT, True, "zlib"
+        )
+        self.assertEqual(compressed_data, expected_output)
+
+    def test_compress_chunk_not_last_chunk(self):
+        """
+        Test compressing data when it is NOT the last chunk
+        """
+        input_data = b"This is a test string"
+        # This output data was generated with compression level 6
+        # As the test is written, if the PigzFile default is changed,
+        # this test data may also need to be updated.
+        expected_output = b"\n\xc9\xc8,V\x00\xa2D\x85\x92\xd4\xe2\x12\x85\xe2\x92\xa2\xcc\xbct\x00\x00\x00\x00\xff\xff"  # noqa; pylint: disable=line-too-long
+        compressed_data = workers.compress_chunk(
+            input_data, pigz_python._COMPRESS_LEVEL_DEFAULT, False, "zlib"
+        )
+        self.assertEqual(compressed_data, expected_output)
+
+    def test_compress_checked_chunk(self):
+        """
+        Test that a chunk compressed as a gzip stream gives the same raw deflate
+        data as a last chunk, and the check value of the chunk
+        """
+        input_data = b"This is a test string"
+        level = pigz_python._COMPRESS_LEVEL_DEFAULT
+        expected_output = workers.compress_chunk(input_data, level, True, "zlib")
+
+        compressed_data, chunk_crc = workers._compress_checked_chunk(
+            input_data, level, "zlib"
+        )
+
+        self.assertEqual(compressed_data, expected_output)
+        self.assertEqual(chunk_crc, zlib.crc32(input_data))
+
+    def test_compress_chunk_worker_checking_engine(self):
+        """
+        Test that the worker takes the check value of the last chunk from the
+        engine when the engine checks data as it compresses
+        """
+        test_file = Path("tests", LOREM_IPSUM_FILE)
+        chunk = test_file.read_bytes()
+        workers.init_worker(test_file)
+        with patch.object(workers, "_CHECKING_ENGINES", {"zlib"}):
+            result = workers.compress_chunk_worker(1, 0, len(chunk), 6, True, "zlib")
+        workers.init_worker(None)
+
+        self.assertEqual(
+            result,
+            (1, zlib.crc32(chunk), len(chunk), zlib.compress(chunk, 6)[2:-4]),
+        )
+
+    def test_compress_chunk_reuses_compressor(self):
+        """
+        Test that the compressor is kept between chunks, and that chunks don't
+        depend on the chunks compressed before them
+        """
+        input_data = b"This is a test string"
+        level = pigz_python._COMPRESS_LEVEL_DEFAULT
+        compressors = workers._worker_compressors.__dict__.setdefault("compressors", {})
+        compressors.clear()
+
+        first_chunk = workers.compress_chunk(input_data, level, False, "zlib")
+        compressor = compressors[("zlib", level)]
+        second_chunk = workers.compress_chunk(input_data, level, False, "zlib")
+        self.assertIs(compressors[("zlib", level)], compressor)
+
+        last_chunk = workers.compress_chunk(input_data, level, True, "zlib")
+        self.assertNotIn(("zlib", level), compressors)
+
+        self.assertEqual(second_chunk, first_chunk)
+        # The last chunk decompresses on its own, without the history of the others
+        self.assertEqual(zlib.decompress(last_chunk, -zlib.MAX_WBITS), input_data)
+
+    def test_compress_chunk_worker(self):
+        """
+        Test that the worker compresses its chunk of the input file, and returns
+        the check value and length of the chunk
+        """
+        chunk_num = 2
+        test_file = Path("tests", LOREM_IPSUM_FILE)
+        chunk = test_file.read_bytes()[100:250]
+        compressed_chunk = b"Jamiroquai"
+        compressed_data = []
+
+        def compress_and_check_chunk(data, *args):
+            # The chunk and dictionary are views released once the worker returns
+            *args, zdict = args
+            compressed_data.append((bytes(data), *args, bytes(zdict)))
+            return compressed_chunk, 8675309
+
+        workers.init_worker(test_file)
+        with patch.object(
+            workers, "_compress_and_check_chunk", new=compress_and_check_chunk
+        ):
+            result = workers.compress_chunk_worker(chunk_num, 100, 150, 9, True, "zlib")
+        workers.init_worker(None)
+
+        self.assertEqual(compressed_data, [(chunk, 9, True, "zlib", b"")])
+        self.assertEqual(result, (chunk_num, 8675309, len(chunk), compressed_chunk))
+
+    def test_compress_chunk_worker_dictionary(self):
+        """
+        Test that the worker primes its chunk with the input before it, which
+        the chunk then decompresses against
+        """
+        test_file = Path("tests", LOREM_IPSUM_FILE)
+        input_data = test_file.read_bytes()
+
+        workers.init_worker(test_file)
+        _, chunk_crc, chunk_len, compressed_chunk = workers.compress_chunk_worker(
+            2, 1000, 1000, 6, True, "zlib", 1000
+        )
+        workers.init_worker(None)
+
+        unprimed_chunk = workers.compress_chunk(input_data[1000:2000], 6, True, "zlib")
+        self.assertLess(len(compressed_chunk), len(unprimed_chunk))
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=input_data[:1000])
+        self.assertEqual(
+            decompressor.decompress(compressed_chunk), input_data[1000:2000]
+        )
+        self.assertEqual(chunk_crc, zlib.crc32(input_data[1000:2000]))
+        self.assertEqual(chunk_len, 1000)
+
+    def test_compress_and_check_chunk(self):
+        """
+        Test that a chunk spanning several tiles is checked and compressed whole
+        """
+        input_data = b"Lorem ipsum dolor sit amet" * 10000
+        self.assertGreater(len(input_data), workers._TILE_SIZE * 2)
+
+        compressed_data, chunk_crc = workers._compress_and_check_chunk(
+            input_data, 6, True, "zlib"
+        )
+
+        self.assertEqual(chunk_crc, zlib.crc32(input_data))
+        self.assertEqual(zlib.decompress(compressed_data, -zlib.MAX_WBITS), input_data)
+
+    def test_compress_chunk_worker_empty_file(self):
+        """
+        Test that the worker handles the single empty chunk of an empty file
+        """
+        with tempfile.TemporaryDirectory() as temp_dir:
+            empty_file = Path(temp_dir, "empty.txt")
+            empty_file.write_bytes(b"")
+            workers.init_worker(empty_file)
+            result = workers.compress_chunk_worker(1, 0, 0, 9, True, "zlib")
+            workers.init_worker(None)
+
+        self.assertEqual(result, (1, 0, 0, zlib.compress(b"", 9)[2:-4]))